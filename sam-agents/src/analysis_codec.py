@@ -0,0 +1,134 @@
+"""
+Analysis Result Codec - Wire formats for flowback.analysis.* messages
+
+Two formats are supported on the analysis subjects:
+
+* ``single`` (legacy): one JSON object per message, no headers.
+* ``batch``: one JSON envelope carrying many results, optionally compressed.
+  The envelope is declared with NATS headers so consumers can decode it
+  without guessing:
+
+      Flowback-Format: batch
+      Flowback-Encoding: identity | gzip | zstd
+      Flowback-Count: <number of results>
+
+Batch results carry ``timestamp`` as epoch milliseconds to keep envelopes
+small. Consumers should call ``decode_analysis_message`` which handles both
+formats and normalizes batch timestamps to the UTC ISO strings of ``single``.
+"""
+
+import gzip
+import json
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional; gzip and identity always work
+    zstandard = None
+
+FORMAT_HEADER = "Flowback-Format"
+ENCODING_HEADER = "Flowback-Encoding"
+COUNT_HEADER = "Flowback-Count"
+
+FORMAT_SINGLE = "single"
+FORMAT_BATCH = "batch"
+
+ENCODING_IDENTITY = "identity"
+ENCODING_GZIP = "gzip"
+ENCODING_ZSTD = "zstd"
+
+ENVELOPE_VERSION = 1
+
+_ENCODINGS = (ENCODING_IDENTITY, ENCODING_GZIP, ENCODING_ZSTD)
+
+
+def resolve_encoding(name: Optional[str]) -> str:
+    """Normalize a configured compression name and check it is usable"""
+    encoding = (name or ENCODING_IDENTITY).strip().lower()
+    if encoding in ("", "none", "off"):
+        encoding = ENCODING_IDENTITY
+    if encoding not in _ENCODINGS:
+        raise ValueError(
+            f"Unknown analysis compression '{name}' (expected one of: none, gzip, zstd)"
+        )
+    if encoding == ENCODING_ZSTD and zstandard is None:
+        raise RuntimeError("zstd compression requested but 'zstandard' is not installed")
+    return encoding
+
+
+def _compress(data: bytes, encoding: str) -> bytes:
+    if encoding == ENCODING_GZIP:
+        return gzip.compress(data, compresslevel=6)
+    if encoding == ENCODING_ZSTD:
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return data
+
+
+def _decompress(data: bytes, encoding: str) -> bytes:
+    if encoding == ENCODING_GZIP:
+        return gzip.decompress(data)
+    if encoding == ENCODING_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("Received zstd analysis batch but 'zstandard' is not installed")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    if encoding != ENCODING_IDENTITY:
+        raise ValueError(f"Unsupported analysis batch encoding '{encoding}'")
+    return data
+
+
+def encode_batch(
+    results: List[Dict[str, Any]], encoding: str = ENCODING_IDENTITY
+) -> Tuple[bytes, Dict[str, str]]:
+    """Encode many results into one batch envelope, returning (payload, headers)"""
+    envelope = {"v": ENVELOPE_VERSION, "results": results}
+    data = json.dumps(envelope, separators=(",", ":")).encode()
+    headers = {
+        FORMAT_HEADER: FORMAT_BATCH,
+        ENCODING_HEADER: encoding,
+        COUNT_HEADER: str(len(results)),
+    }
+    return _compress(data, encoding), headers
+
+
+def split_batches(
+    results: List[Dict[str, Any]], encoding: str, max_bytes: int
+) -> Tuple[List[Tuple[List[Dict[str, Any]], bytes, Dict[str, str]]], List[Dict[str, Any]]]:
+    """Encode results into envelopes of at most max_bytes each.
+
+    Returns (chunks, oversized) where each chunk is (results, payload, headers)
+    and oversized holds results too large to fit in an envelope on their own.
+    """
+    payload, headers = encode_batch(results, encoding)
+    if len(payload) <= max_bytes:
+        return [(results, payload, headers)], []
+    if len(results) == 1:
+        return [], results
+
+    mid = len(results) // 2
+    left, left_oversized = split_batches(results[:mid], encoding, max_bytes)
+    right, right_oversized = split_batches(results[mid:], encoding, max_bytes)
+    return left + right, left_oversized + right_oversized
+
+
+def decode_analysis_message(
+    data: bytes, headers: Optional[Mapping[str, str]] = None
+) -> List[Dict[str, Any]]:
+    """Decode a message from an analysis subject into a list of results"""
+    headers = headers or {}
+    if headers.get(FORMAT_HEADER, FORMAT_SINGLE) != FORMAT_BATCH:
+        return [json.loads(data.decode())]
+
+    encoding = headers.get(ENCODING_HEADER, ENCODING_IDENTITY)
+    envelope = json.loads(_decompress(data, encoding).decode())
+    version = envelope.get("v")
+    if version != ENVELOPE_VERSION:
+        raise ValueError(f"Unsupported analysis batch version {version}")
+    results = list(envelope.get("results") or [])
+    for result in results:
+        timestamp = result.get("timestamp")
+        if isinstance(timestamp, (int, float)):
+            result["timestamp"] = datetime.fromtimestamp(
+                timestamp / 1000, tz=timezone.utc
+            ).isoformat()
+    return results
@@ -0,0 +1,113 @@
+"""
+Round-trip check of the analysis result wire formats (no NATS server needed).
+
+Encodes results with every available codec, splits an envelope that exceeds
+a payload limit, and asserts that decode_analysis_message returns the same
+results, with batch timestamps normalized to the UTC ISO strings of the
+single format.
+
+    uv run python src/codec_check.py
+"""
+
+import json
+from datetime import datetime, timezone
+
+from analysis_codec import (
+    ENCODING_GZIP,
+    ENCODING_IDENTITY,
+    ENCODING_ZSTD,
+    decode_analysis_message,
+    encode_batch,
+    split_batches,
+    zstandard,
+)
+
+
+def make_results(count: int, analysis_size: int = 40):
+    base = 1705424400000
+    return [
+        {
+            "sessionId": f"s_{i:05d}",
+            "type": "friction.analysis",
+            "timestamp": base + i,
+            "analysis": "x" * analysis_size,
+        }
+        for i in range(count)
+    ]
+
+
+def expected(results):
+    """What consumers should see: batch timestamps as UTC ISO strings"""
+    return [
+        dict(
+            result,
+            timestamp=datetime.fromtimestamp(
+                result["timestamp"] / 1000, tz=timezone.utc
+            ).isoformat(),
+        )
+        for result in results
+    ]
+
+
+def check_single():
+    result = {
+        "sessionId": "s_single",
+        "type": "friction.analysis",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "analysis": "Session has 5 interactions: 5 click",
+    }
+    assert decode_analysis_message(json.dumps(result).encode()) == [result]
+    assert decode_analysis_message(json.dumps(result).encode(), {}) == [result]
+    print("single: ok")
+
+
+def check_round_trip(encoding: str):
+    results = make_results(200)
+    payload, headers = encode_batch(results, encoding)
+    assert headers["Flowback-Count"] == "200"
+    decoded = decode_analysis_message(payload, headers)
+    assert decoded == expected(results), f"{encoding} round trip changed results"
+    assert decoded[0]["timestamp"] == "2024-01-16T17:00:00+00:00", decoded[0]["timestamp"]
+    print(f"{encoding}: ok ({len(payload)} bytes for {len(results)} results)")
+
+
+def check_split(encoding: str):
+    results = make_results(300, analysis_size=200)
+    # Relative to this codec's full envelope, so compressed codecs split too
+    max_bytes = len(encode_batch(results, encoding)[0]) // 3
+    chunks, oversized = split_batches(results, encoding, max_bytes)
+    assert not oversized
+    assert len(chunks) > 1, "expected the envelope to be split"
+    assert all(len(payload) <= max_bytes for _, payload, _ in chunks)
+
+    decoded = [
+        result
+        for _, payload, headers in chunks
+        for result in decode_analysis_message(payload, headers)
+    ]
+    assert decoded == expected(results), f"{encoding} split lost or reordered results"
+    envelopes = len(chunks)
+
+    # A single result larger than the limit is reported, not retried
+    huge = make_results(1, analysis_size=16384)
+    kept, oversized = split_batches(results[:3] + huge, ENCODING_IDENTITY, 4096)
+    assert oversized == huge
+    assert sum(len(chunk) for chunk, _, _ in kept) == 3
+    print(f"{encoding} split: ok ({envelopes} envelopes)")
+
+
+def main():
+    check_single()
+    encodings = [ENCODING_IDENTITY, ENCODING_GZIP]
+    if zstandard is not None:
+        encodings.append(ENCODING_ZSTD)
+    else:
+        print("zstd: skipped ('zstandard' not installed; uv sync --extra zstd)")
+    for encoding in encodings:
+        check_round_trip(encoding)
+        check_split(encoding)
+    print("Codec check passed")
+
+
+if __name__ == "__main__":
+    main()
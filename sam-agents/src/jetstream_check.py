@@ -0,0 +1,134 @@
+"""
+End-to-end check of JetStream mode against a local nats-server started with -js.
+
+Runs nats_bridge.py with NATS_JETSTREAM=true, stops it while a session is
+only partly buffered, restarts it and asserts that the buffered events are
+redelivered, the session is analyzed and every signal event is acked.
+Covers both a graceful stop (SIGINT) and a crash (SIGKILL).
+
+    uv run python src/jetstream_check.py
+"""
+
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import uuid
+
+import nats
+
+from analysis_codec import decode_analysis_message
+from jetstream_consumer import EVENTS_STREAM
+
+BRIDGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "nats_bridge.py")
+SIGNAL_DURABLE = "nats-bridge-signals"
+ACK_WAIT = 5
+
+
+def start_bridge(nats_url: str) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        NATS_URL=nats_url,
+        NATS_JETSTREAM="true",
+        NATS_ACK_WAIT=str(ACK_WAIT),
+        # Keep partial sessions buffered for the whole check
+        SESSION_IDLE_TIMEOUT="120",
+    )
+    return subprocess.Popen([sys.executable, BRIDGE], env=env)
+
+
+async def wait_until_pulling(js, timeout: float = 15):
+    """Wait until the bridge has a pull request waiting on the signal consumer"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            info = await js.consumer_info(EVENTS_STREAM, SIGNAL_DURABLE)
+            if info.num_waiting > 0:
+                return
+        except Exception:
+            pass
+        await asyncio.sleep(0.2)
+    raise AssertionError("Bridge did not start pulling in time")
+
+
+async def publish_events(nc, session_id: str, count: int):
+    base = int(time.time() * 1000)
+    for i in range(count):
+        event = {
+            "sessionId": session_id,
+            "projectId": "demo",
+            "timestamp": base + i * 200,
+            "type": "signal.raw",
+            "payload": {"action": "click", "target": "#btn"},
+        }
+        await nc.publish("flowback.signal.raw", json.dumps(event).encode())
+    await nc.flush()
+
+
+async def unacked(js) -> int:
+    info = await js.consumer_info(EVENTS_STREAM, SIGNAL_DURABLE)
+    return info.num_ack_pending
+
+
+async def check_restart(nc, js, nats_url: str, stop_signal: int, label: str):
+    session_id = f"s_check_{uuid.uuid4().hex[:8]}"
+    analyzed = asyncio.Event()
+    results = []
+
+    async def handler(msg):
+        for result in decode_analysis_message(msg.data, msg.headers):
+            if result.get("sessionId") == session_id:
+                results.append(result)
+                analyzed.set()
+
+    sub = await nc.subscribe("flowback.analysis.friction", cb=handler)
+
+    bridge = start_bridge(nats_url)
+    try:
+        await wait_until_pulling(js)
+        await publish_events(nc, session_id, 3)
+        await asyncio.sleep(1)
+        held = await unacked(js)
+        assert held >= 3, f"expected 3 buffered events to stay unacked, got {held}"
+        print(f"[{label}] 3 events buffered and unacked")
+    finally:
+        bridge.send_signal(stop_signal)
+        bridge.wait(timeout=15)
+
+    bridge = start_bridge(nats_url)
+    try:
+        await wait_until_pulling(js)
+        await publish_events(nc, session_id, 2)
+        # After a crash the held events only return once ack_wait expires
+        await asyncio.wait_for(analyzed.wait(), timeout=ACK_WAIT + 15)
+        analysis = results[0].get("analysis", "")
+        assert "5 interactions" in analysis, f"expected all 5 events analyzed: {analysis}"
+        print(f"[{label}] buffered events redelivered and session analyzed")
+
+        await asyncio.sleep(2)
+        remaining = await unacked(js)
+        assert remaining == 0, f"expected all signal events acked, {remaining} unacked"
+        print(f"[{label}] all signal events acked")
+    finally:
+        bridge.send_signal(signal.SIGINT)
+        bridge.wait(timeout=15)
+        await sub.unsubscribe()
+
+
+async def main():
+    nats_url = os.getenv("NATS_URL", "nats://localhost:4222")
+    nc = await nats.connect(nats_url)
+    js = nc.jetstream()
+    try:
+        await check_restart(nc, js, nats_url, signal.SIGINT, "graceful")
+        await check_restart(nc, js, nats_url, signal.SIGKILL, "crash")
+        print("JetStream check passed")
+    finally:
+        await nc.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
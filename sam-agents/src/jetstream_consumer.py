@@ -0,0 +1,205 @@
+"""
+JetStream Consumer Helpers - Durable pull consumption for the NATS bridges
+
+The bridges use core NATS push subscriptions by default. With NATS_JETSTREAM
+enabled they instead pull from durable consumers, so a restart resumes from
+the last acknowledged message and throughput follows our processing speed.
+
+Streams capture the subjects the Node.js services already publish to with
+core NATS, so producers do not need to change. They use work-queue retention,
+so messages are removed once acked. max_age, max_bytes and max_msgs bound what
+is kept when nothing consumes a stream; the oldest messages are discarded first.
+"""
+
+import asyncio
+import logging
+import os
+from typing import List, Optional, Sequence
+
+import nats
+from nats.aio.msg import Msg
+from nats.errors import TimeoutError as NATSTimeoutError
+from nats.js import JetStreamContext
+from nats.js.api import (
+    AckPolicy,
+    ConsumerConfig,
+    DeliverPolicy,
+    DiscardPolicy,
+    RetentionPolicy,
+)
+from nats.js.errors import NotFoundError
+
+log = logging.getLogger(__name__)
+
+EVENTS_STREAM = "FLOWBACK_EVENTS"
+EVENTS_SUBJECTS = ["flowback.signal.raw", "flowback.feedback.recorded"]
+
+ANALYSIS_STREAM = "FLOWBACK_ANALYSIS"
+ANALYSIS_SUBJECTS = ["flowback.analysis.>"]
+
+
+def jetstream_enabled() -> bool:
+    """Whether NATS_JETSTREAM is set to a truthy value"""
+    return os.getenv("NATS_JETSTREAM", "false").strip().lower() in ("1", "true", "yes", "on")
+
+
+async def ensure_stream(
+    js: JetStreamContext,
+    name: str,
+    subjects: List[str],
+    max_age: float,
+    max_bytes: int = -1,
+    max_msgs: int = -1,
+):
+    """Create the stream, or check an existing one and apply our limits"""
+    try:
+        info = await js.stream_info(name)
+    except NotFoundError:
+        await js.add_stream(
+            name=name,
+            subjects=subjects,
+            retention=RetentionPolicy.WORK_QUEUE,
+            discard=DiscardPolicy.OLD,
+            max_age=max_age,
+            max_bytes=max_bytes,
+            max_msgs=max_msgs,
+        )
+        log.info(f"✓ Created JetStream stream {name} ({', '.join(subjects)})")
+        return
+
+    config = info.config
+    if sorted(config.subjects or []) != sorted(subjects):
+        raise RuntimeError(
+            f"Stream {name} has subjects {config.subjects}, expected {subjects}"
+        )
+    if config.retention != RetentionPolicy.WORK_QUEUE:
+        raise RuntimeError(
+            f"Stream {name} uses {config.retention} retention, expected workqueue"
+        )
+
+    # Limits are editable, so bring an existing stream in line with ours
+    if (config.max_age, config.max_bytes, config.max_msgs) != (max_age, max_bytes, max_msgs):
+        config.max_age = max_age
+        config.max_bytes = max_bytes
+        config.max_msgs = max_msgs
+        try:
+            await js.update_stream(config)
+            log.info(f"✓ Updated limits of JetStream stream {name}")
+        except Exception as e:
+            log.warning(f"⚠️ Could not update limits of stream {name}: {e}")
+
+
+async def durable_pull_subscribe(
+    js: JetStreamContext,
+    subject: str,
+    durable: str,
+    stream: str,
+    max_ack_pending: int,
+    ack_wait: float,
+    max_deliver: int = -1,
+) -> JetStreamContext.PullSubscription:
+    """Bind to (or create) a durable pull consumer with explicit acks"""
+    config = ConsumerConfig(
+        durable_name=durable,
+        deliver_policy=DeliverPolicy.ALL,
+        ack_policy=AckPolicy.EXPLICIT,
+        ack_wait=ack_wait,
+        max_ack_pending=max_ack_pending,
+        max_deliver=max_deliver,
+        filter_subject=subject,
+    )
+    # pull_subscribe only binds to an existing durable, so create or update
+    # it explicitly to apply changed settings from a previous run
+    try:
+        await js.add_consumer(stream, config)
+    except Exception as e:
+        log.warning(f"⚠️ Could not update consumer '{durable}': {e}")
+    psub = await js.pull_subscribe(subject, durable=durable, stream=stream)
+
+    info = await psub.consumer_info()
+    current = info.config
+    if (
+        current.max_ack_pending != max_ack_pending
+        or current.max_deliver != max_deliver
+        or abs((current.ack_wait or 0) - ack_wait) > 0.001
+    ):
+        log.warning(
+            f"⚠️ Consumer '{durable}' runs with max_ack_pending={current.max_ack_pending}, "
+            f"ack_wait={current.ack_wait}s, max_deliver={current.max_deliver} "
+            f"instead of the configured values"
+        )
+    log.info(
+        f"✓ Pulling {subject} via durable '{durable}' "
+        f"(pending={info.num_pending}, unacked={info.num_ack_pending})"
+    )
+    return psub
+
+
+async def fetch_batch(
+    psub: JetStreamContext.PullSubscription, size: int, timeout: float
+) -> List[Msg]:
+    """Fetch up to `size` messages, returning an empty list when idle"""
+    try:
+        return await psub.fetch(batch=size, timeout=timeout)
+    except NATSTimeoutError:
+        return []
+
+
+async def ack_batch(nc: nats.NATS, msgs: Sequence[Msg]):
+    """Ack a group of messages and flush them to the server together"""
+    if not msgs:
+        return
+    outcomes = await asyncio.gather(*(msg.ack() for msg in msgs), return_exceptions=True)
+    failed = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+    if failed:
+        # Unacked messages are redelivered after ack_wait
+        log.warning(f"⚠️ Failed to ack {len(failed)} of {len(msgs)} messages: {failed[0]}")
+    await nc.flush()
+
+
+async def term_batch(msgs: Sequence[Msg]):
+    """Stop redelivery of messages that can never be processed"""
+    if not msgs:
+        return
+    outcomes = await asyncio.gather(*(msg.term() for msg in msgs), return_exceptions=True)
+    failed = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+    if failed:
+        log.warning(f"⚠️ Failed to terminate {len(failed)} messages: {failed[0]}")
+
+
+async def keep_alive(msgs: Sequence[Msg], interval: float):
+    """Reset ack_wait for messages still being processed, until cancelled"""
+    while True:
+        await asyncio.sleep(interval)
+        outcomes = await asyncio.gather(
+            *(msg.in_progress() for msg in msgs), return_exceptions=True
+        )
+        failed = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+        if failed:
+            log.warning(f"⚠️ Failed to extend {len(failed)} of {len(msgs)} messages: {failed[0]}")
+
+
+def retry_delay(msg: Msg, base: float, cap: float = 60.0) -> float:
+    """Exponential redelivery delay based on how often the message was delivered"""
+    return min(cap, base * 2 ** (msg.metadata.num_delivered - 1))
+
+
+async def nak_batch(msgs: Sequence[Msg], retry_base: Optional[float] = None):
+    """Request redelivery for a group of messages.
+
+    With retry_base set, each message backs off exponentially so a short
+    outage does not use up max_deliver within milliseconds.
+    """
+    if not msgs:
+        return
+    outcomes = await asyncio.gather(
+        *(
+            msg.nak(delay=retry_delay(msg, retry_base) if retry_base else None)
+            for msg in msgs
+        ),
+        return_exceptions=True,
+    )
+    failed = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+    if failed:
+        # These fall back to redelivery after ack_wait
+        log.warning(f"⚠️ Failed to nak {len(failed)} of {len(msgs)} messages: {failed[0]}")
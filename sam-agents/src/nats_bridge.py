@@ -9,28 +9,104 @@ import asyncio
 import json
 import logging
 import os
-from datetime import datetime
+import time
+from datetime import datetime, timezone
 from typing import Any, Dict, List, Optional
 
 import nats
 from nats.aio.msg import Msg
+from nats.errors import MaxPayloadError
+
+from analysis_codec import FORMAT_BATCH, FORMAT_SINGLE, resolve_encoding, split_batches
+from jetstream_consumer import (
+    ANALYSIS_STREAM,
+    ANALYSIS_SUBJECTS,
+    EVENTS_STREAM,
+    EVENTS_SUBJECTS,
+    ack_batch,
+    durable_pull_subscribe,
+    ensure_stream,
+    fetch_batch,
+    jetstream_enabled,
+    nak_batch,
+    term_batch,
+)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
 
+ANALYSIS_SUBJECT = "flowback.analysis.friction"
+
+
 class NATSEventBridge:
-    def __init__(self, nats_url: str = "nats://localhost:4222"):
+    def __init__(
+        self,
+        nats_url: str = "nats://localhost:4222",
+        publish_format: str = FORMAT_SINGLE,
+        batch_size: int = 500,
+        batch_interval: float = 0.25,
+        compression: str = "none",
+        max_buffered_results: int = 10000,
+        jetstream: bool = False,
+        fetch_size: int = 100,
+        fetch_timeout: float = 1.0,
+        max_ack_pending: int = 10000,
+        ack_wait: float = 300.0,
+        retry_delay: float = 2.0,
+        session_idle_timeout: float = 30.0,
+        stream_max_age: float = 86400.0,
+        stream_max_bytes: int = 1024**3,
+        stream_max_msgs: int = 1_000_000,
+    ):
+        if publish_format not in (FORMAT_SINGLE, FORMAT_BATCH):
+            raise ValueError(f"Unknown analysis publish format '{publish_format}'")
+        if 0 < max_ack_pending <= fetch_size:
+            raise ValueError(
+                f"max_ack_pending ({max_ack_pending}) must exceed the fetch size ({fetch_size})"
+            )
         self.nats_url = nats_url
         self.nc: nats.NATS | None = None
         self.event_buffer: Dict[str, List[Dict[str, Any]]] = {}
 
+        # Batched publishing of analysis results (see analysis_codec)
+        self.publish_format = publish_format
+        self.batch_size = max(1, batch_size)
+        self.batch_interval = batch_interval
+        self.compression = resolve_encoding(compression)
+        self.max_buffered_results = max(self.batch_size, max_buffered_results)
+        self.result_buffer: List[Dict[str, Any]] = []
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: asyncio.Task | None = None
+
+        # Optional JetStream durable pull consumption (see jetstream_consumer)
+        self.jetstream = jetstream
+        self.fetch_size = max(1, fetch_size)
+        self.fetch_timeout = fetch_timeout
+        self.max_ack_pending = max_ack_pending
+        self.ack_wait = ack_wait
+        self.retry_delay = retry_delay
+        self.session_idle_timeout = session_idle_timeout
+        self.stream_max_age = stream_max_age
+        self.stream_max_bytes = stream_max_bytes
+        self.stream_max_msgs = stream_max_msgs
+        self.js = None
+        self._signal_sub = None
+        self._feedback_sub = None
+        # Buffered events stay unacked until their session has been analyzed
+        self.pending_msgs: Dict[str, List[Msg]] = {}
+        self.buffered_seqs: set[int] = set()
+        self.session_last_seen: Dict[str, float] = {}
+        self.ack_ready: List[Msg] = []
+
     async def connect(self):
         """Connect to NATS broker"""
         try:
             self.nc = await nats.connect(self.nats_url)
             log.info(f"✓ Connected to NATS at {self.nats_url}")
+            if self.jetstream:
+                self.js = self.nc.jetstream()
         except Exception as e:
             log.error(f"❌ Failed to connect to NATS: {e}")
             raise
@@ -40,6 +116,10 @@ class NATSEventBridge:
         if not self.nc:
             raise RuntimeError("Not connected to NATS")
 
+        if self.js:
+            await self.subscribe_durable()
+            return
+
         # Subscribe to raw signals from ingest service
         await self.nc.subscribe("flowback.signal.raw", cb=self.handle_signal_event)
         log.info("✓ Subscribed to flowback.signal.raw")
@@ -48,11 +128,60 @@ class NATSEventBridge:
         await self.nc.subscribe("flowback.feedback.recorded", cb=self.handle_feedback_event)
         log.info("✓ Subscribed to flowback.feedback.recorded")
 
+    async def subscribe_durable(self):
+        """Bind durable pull consumers for signals and feedback"""
+        if self.session_idle_timeout >= self.ack_wait:
+            log.warning(
+                "⚠️ Session idle timeout is not below ack_wait; "
+                "buffered events will be redelivered before analysis"
+            )
+        limits = dict(
+            max_age=self.stream_max_age,
+            max_bytes=self.stream_max_bytes,
+            max_msgs=self.stream_max_msgs,
+        )
+        await ensure_stream(self.js, EVENTS_STREAM, EVENTS_SUBJECTS, **limits)
+        await ensure_stream(self.js, ANALYSIS_STREAM, ANALYSIS_SUBJECTS, **limits)
+
+        # Results published here are only removed once results_bridge acks them
+        analysis_info = await self.js.stream_info(ANALYSIS_STREAM)
+        if not analysis_info.state.consumer_count:
+            log.warning(
+                f"⚠️ No consumers on {ANALYSIS_STREAM}; run results_bridge.py with "
+                f"NATS_JETSTREAM=true or results pile up until the stream limits"
+            )
+
+        # Events left unacked by a previous run are redelivered here and
+        # rebuild the session buffers before new events are analyzed
+        self._signal_sub = await durable_pull_subscribe(
+            self.js,
+            "flowback.signal.raw",
+            durable="nats-bridge-signals",
+            stream=EVENTS_STREAM,
+            max_ack_pending=self.max_ack_pending,
+            ack_wait=self.ack_wait,
+        )
+        self._feedback_sub = await durable_pull_subscribe(
+            self.js,
+            "flowback.feedback.recorded",
+            durable="nats-bridge-feedback",
+            stream=EVENTS_STREAM,
+            max_ack_pending=self.max_ack_pending,
+            ack_wait=self.ack_wait,
+        )
+
     async def handle_signal_event(self, msg: Msg):
         """Process raw signal events"""
+        tracked = False
         try:
             event = json.loads(msg.data.decode())
             session_id = event.get("sessionId") or "unknown"
+            if self.js:
+                if not self._track_pending(session_id, msg):
+                    log.debug("Ignoring redelivery of buffered signal event")
+                    return
+                tracked = True
+
             payload = event.get("payload") or {}
             action = payload.get("action") or event.get("action") or "unknown"
 
@@ -71,11 +200,78 @@ class NATSEventBridge:
 
             # Analyze when we have enough events
             if len(self.event_buffer[session_id]) >= 5:
-                await self.analyze_session(session_id)
+                analyzed = await self.analyze_session(session_id)
                 self.event_buffer[session_id] = []
+                if self.js:
+                    await self._settle_session(session_id, analyzed)
 
         except Exception as e:
             log.error(f"❌ Error handling signal event: {e}", exc_info=True)
+            if self.js:
+                # Bad events would otherwise be redelivered forever. Release
+                # the message first so it is never acked after terminating.
+                if tracked:
+                    self._untrack_pending(session_id, msg)
+                await term_batch([msg])
+
+    def _track_pending(self, session_id: str, msg: Msg) -> bool:
+        """Hold a JetStream message until its session is analyzed.
+
+        Returns False when the message is a redelivery of an event that is
+        already buffered (its ack_wait expired while the session filled up).
+        """
+        self.pending_msgs.setdefault(session_id, []).append(msg)
+        self.session_last_seen[session_id] = time.monotonic()
+        seq = msg.metadata.sequence.stream
+        if seq in self.buffered_seqs:
+            return False
+        self.buffered_seqs.add(seq)
+        return True
+
+    def _untrack_pending(self, session_id: str, msg: Msg):
+        """Forget a held message, e.g. before terminating it"""
+        held = [m for m in self.pending_msgs.get(session_id, []) if m is not msg]
+        if held:
+            self.pending_msgs[session_id] = held
+        else:
+            self.pending_msgs.pop(session_id, None)
+            self.session_last_seen.pop(session_id, None)
+        self.buffered_seqs.discard(msg.metadata.sequence.stream)
+
+    async def _settle_session(self, session_id: str, analyzed: bool):
+        """Queue a session's messages for ack, or redeliver them on failure"""
+        msgs = self.pending_msgs.pop(session_id, [])
+        self.event_buffer.pop(session_id, None)
+        self.session_last_seen.pop(session_id, None)
+        for msg in msgs:
+            self.buffered_seqs.discard(msg.metadata.sequence.stream)
+        if analyzed:
+            self.ack_ready.extend(msgs)
+        else:
+            await nak_batch(msgs, retry_base=self.retry_delay)
+
+    async def analyze_idle_sessions(self):
+        """Analyze partial sessions so their events do not stay unacked forever.
+
+        A session is analyzed early once it has been idle for
+        session_idle_timeout, or when held events approach max_ack_pending
+        and the server would otherwise stop delivering.
+        """
+        now = time.monotonic()
+        # max_ack_pending <= 0 means unlimited, so only idleness applies
+        held_limit = (
+            self.max_ack_pending - self.fetch_size if self.max_ack_pending > 0 else None
+        )
+        # Oldest first, so backpressure releases the longest-held sessions
+        for session_id, last_seen in sorted(
+            self.session_last_seen.items(), key=lambda item: item[1]
+        ):
+            idle = now - last_seen >= self.session_idle_timeout
+            pressured = held_limit is not None and len(self.buffered_seqs) >= held_limit
+            if not idle and not pressured:
+                break
+            analyzed = await self.analyze_session(session_id)
+            await self._settle_session(session_id, analyzed)
 
     async def handle_feedback_event(self, msg: Msg):
         """Process user feedback events"""
@@ -92,7 +288,7 @@ class NATSEventBridge:
         """Send buffered events to Friction Analyzer agent"""
         events = self.event_buffer.get(session_id, [])
         if not events:
-            return
+            return True
 
         # Format events for analysis
         event_summary = self.summarize_events(events)
@@ -102,7 +298,7 @@ class NATSEventBridge:
 
         # In a real implementation, this would call the SAM agent via HTTP or message bus
         # For now, we just log the analysis
-        await self.store_analysis_result(session_id, event_summary)
+        return await self.store_analysis_result(session_id, event_summary)
 
     def summarize_events(self, events: List[Dict[str, Any]]) -> str:
         """Create a summary of events aligned to the schema in docs/EVENT_SCHEMA"""
@@ -150,18 +346,175 @@ class NATSEventBridge:
         result = {
             "sessionId": session_id,
             "type": "friction.analysis",
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
             "analysis": analysis,
         }
 
-        if self.nc:
+        if self.publish_format == FORMAT_BATCH or self.js:
+            if self.publish_format == FORMAT_BATCH:
+                # Epoch millis on the wire; decode_analysis_message restores ISO
+                result["timestamp"] = int(time.time() * 1000)
+            # In JetStream mode single results are buffered too, so their
+            # PubAcks are awaited together before the inputs are acked
+            self.result_buffer.append(result)
+            if self.publish_format == FORMAT_BATCH and len(self.result_buffer) >= self.batch_size:
+                await self.flush_analysis_results()
+            # Failed flushes keep results buffered, so the result is not lost
+            return True
+
+        if not self.nc:
+            return False
+        try:
+            await self._publish(ANALYSIS_SUBJECT, json.dumps(result).encode())
+            log.info(f"✓ Published analysis for session {session_id[:8]}")
+            return True
+        except Exception as e:
+            log.error(f"❌ Failed to publish analysis: {e}")
+            return False
+
+    async def _publish(
+        self, subject: str, payload: bytes, headers: Optional[Dict[str, str]] = None
+    ):
+        """Publish via JetStream when enabled so the result is confirmed stored"""
+        if self.js:
+            await self.js.publish(subject, payload, headers=headers)
+        else:
+            await self.nc.publish(subject, payload, headers=headers)
+
+    async def flush_analysis_results(self):
+        """Publish buffered analysis results; False if some are kept for retry"""
+        async with self._flush_lock:
+            if not self.result_buffer:
+                return True
+            if not self.nc:
+                return False
+
+            results = self.result_buffer
+            self.result_buffer = []
+            unsent = results
             try:
-                await self.nc.publish(
-                    "flowback.analysis.friction", json.dumps(result).encode()
-                )
-                log.info(f"✓ Published analysis for session {session_id[:8]}")
+                if self.publish_format == FORMAT_BATCH:
+                    unsent = await self._publish_batches(results)
+                else:
+                    unsent = await self._publish_singles(results)
+            finally:
+                # Also runs on cancellation, so swapped-out results survive
+                if unsent:
+                    self._restore_results(unsent)
+            return not unsent
+
+    async def _publish_batches(
+        self, results: List[Dict[str, Any]]
+    ) -> List[Dict[str, Any]]:
+        """Publish results as envelopes, returning those that must be retried"""
+        # Leave room for the Flowback-* headers within max_payload
+        chunks, oversized = split_batches(
+            results, self.compression, self.nc.max_payload - 256
+        )
+        for result in oversized:
+            log.error(
+                f"❌ Dropped analysis for session {result.get('sessionId', 'unknown')[:8]}: "
+                f"too large for max_payload"
+            )
+        for i, (chunk, payload, headers) in enumerate(chunks):
+            try:
+                await self._publish(ANALYSIS_SUBJECT, payload, headers=headers)
+            except MaxPayloadError as e:
+                # Retrying cannot succeed, so drop instead of poisoning the buffer
+                log.error(f"❌ Dropped analysis batch of {len(chunk)} results: {e}")
+                continue
+            except Exception as e:
+                log.error(f"❌ Failed to publish analysis batch: {e}")
+                return [result for rest, _, _ in chunks[i:] for result in rest]
+            log.info(
+                f"✓ Published analysis batch: {len(chunk)} results, "
+                f"{len(payload)} bytes ({self.compression})"
+            )
+        return []
+
+    async def _publish_singles(
+        self, results: List[Dict[str, Any]]
+    ) -> List[Dict[str, Any]]:
+        """Publish results one per message concurrently, returning failures"""
+        outcomes = await asyncio.gather(
+            *(self._publish(ANALYSIS_SUBJECT, json.dumps(result).encode()) for result in results),
+            return_exceptions=True,
+        )
+        unsent = [
+            result
+            for result, outcome in zip(results, outcomes)
+            if isinstance(outcome, BaseException)
+        ]
+        if unsent:
+            log.error(f"❌ Failed to publish {len(unsent)} of {len(results)} analysis results")
+        else:
+            log.info(f"✓ Published {len(results)} analysis results")
+        return unsent
+
+    def _restore_results(self, results: List[Dict[str, Any]]):
+        """Put unsent results back for the next flush, dropping the oldest past the cap"""
+        self.result_buffer = results + self.result_buffer
+        overflow = len(self.result_buffer) - self.max_buffered_results
+        # In JetStream mode max_ack_pending bounds the buffer, and dropping
+        # would lose results whose input events are about to be acked
+        if overflow > 0 and not self.js:
+            self.result_buffer = self.result_buffer[overflow:]
+            log.error(f"❌ Dropped {overflow} oldest analysis results (buffer full)")
+
+    async def _flush_periodically(self):
+        """Flush partially filled batches so results are not held indefinitely"""
+        while True:
+            await asyncio.sleep(self.batch_interval)
+            await self.flush_analysis_results()
+
+    async def consume_signals(self):
+        """Pull signal batches and ack every event whose session was analyzed"""
+        while True:
+            try:
+                msgs = await fetch_batch(self._signal_sub, self.fetch_size, self.fetch_timeout)
+                for msg in msgs:
+                    await self.handle_signal_event(msg)
+                await self.analyze_idle_sessions()
+                await self.ack_analyzed()
             except Exception as e:
-                log.error(f"❌ Failed to publish analysis: {e}")
+                # e.g. a reconnect; unacked events are redelivered after ack_wait
+                log.error(f"❌ Error consuming signal events: {e}", exc_info=True)
+                await asyncio.sleep(1)
+
+    async def consume_feedback(self):
+        """Pull feedback batches and ack each batch once handled"""
+        while True:
+            try:
+                msgs = await fetch_batch(self._feedback_sub, self.fetch_size, self.fetch_timeout)
+                for msg in msgs:
+                    await self.handle_feedback_event(msg)
+                await ack_batch(self.nc, msgs)
+            except Exception as e:
+                log.error(f"❌ Error consuming feedback events: {e}", exc_info=True)
+                await asyncio.sleep(1)
+
+    async def ack_analyzed(self):
+        """Ack analyzed events once their results have been published"""
+        if not self.ack_ready:
+            return
+        # Results must be stored in the stream before their inputs are acked
+        if not await self.flush_analysis_results():
+            return
+
+        msgs = self.ack_ready
+        self.ack_ready = []
+        await ack_batch(self.nc, msgs)
+        log.debug(f"✓ Acked {len(msgs)} analyzed signal events")
+
+    async def release_buffered(self):
+        """Hand buffered, unanalyzed events back for immediate redelivery"""
+        msgs = [msg for held in self.pending_msgs.values() for msg in held]
+        self.pending_msgs = {}
+        self.buffered_seqs = set()
+        self.session_last_seen = {}
+        await nak_batch(msgs)
+        if msgs:
+            log.info(f"↩ Released {len(msgs)} buffered signal events for redelivery")
 
     async def run(self):
         """Run the NATS event bridge"""
@@ -171,20 +524,63 @@ class NATSEventBridge:
 
             log.info("🚀 NATS Event Bridge running. Listening for Flowback events...")
             log.info("   Events buffered until analysis threshold reached")
+            if self.publish_format == FORMAT_BATCH:
+                log.info(
+                    f"   Publishing analysis in batches of {self.batch_size} "
+                    f"(every {self.batch_interval}s, compression={self.compression})"
+                )
+                self._flush_task = asyncio.create_task(self._flush_periodically())
 
-            # Keep running
-            while True:
-                await asyncio.sleep(1)
+            if self.js:
+                log.info(
+                    f"   JetStream pull mode: batches of {self.fetch_size}, "
+                    f"max_ack_pending={self.max_ack_pending}"
+                )
+                await asyncio.gather(self.consume_signals(), self.consume_feedback())
+            else:
+                # Keep running
+                while True:
+                    await asyncio.sleep(1)
 
         except KeyboardInterrupt:
             log.info("Shutting down...")
         finally:
+            if self._flush_task:
+                self._flush_task.cancel()
+                try:
+                    await self._flush_task
+                except asyncio.CancelledError:
+                    pass
             if self.nc:
+                try:
+                    if self.js:
+                        await self.ack_analyzed()
+                        await self.release_buffered()
+                    await self.flush_analysis_results()
+                except Exception as e:
+                    log.error(f"❌ Error during shutdown: {e}", exc_info=True)
                 await self.nc.close()
 
 
 async def main():
-    bridge = NATSEventBridge(os.getenv("NATS_URL", "nats://localhost:4222"))
+    bridge = NATSEventBridge(
+        nats_url=os.getenv("NATS_URL", "nats://localhost:4222"),
+        publish_format=os.getenv("ANALYSIS_PUBLISH_FORMAT", FORMAT_SINGLE),
+        batch_size=int(os.getenv("ANALYSIS_BATCH_SIZE", "500")),
+        batch_interval=float(os.getenv("ANALYSIS_BATCH_INTERVAL", "0.25")),
+        compression=os.getenv("ANALYSIS_COMPRESSION", "none"),
+        max_buffered_results=int(os.getenv("ANALYSIS_MAX_BUFFERED", "10000")),
+        jetstream=jetstream_enabled(),
+        fetch_size=int(os.getenv("NATS_FETCH_SIZE", "100")),
+        fetch_timeout=float(os.getenv("NATS_FETCH_TIMEOUT", "1.0")),
+        max_ack_pending=int(os.getenv("NATS_MAX_ACK_PENDING", "10000")),
+        ack_wait=float(os.getenv("NATS_ACK_WAIT", "300")),
+        retry_delay=float(os.getenv("NATS_RETRY_DELAY", "2")),
+        session_idle_timeout=float(os.getenv("SESSION_IDLE_TIMEOUT", "30")),
+        stream_max_age=float(os.getenv("NATS_STREAM_MAX_AGE", "86400")),
+        stream_max_bytes=int(os.getenv("NATS_STREAM_MAX_BYTES", str(1024**3))),
+        stream_max_msgs=int(os.getenv("NATS_STREAM_MAX_MSGS", "1000000")),
+    )
     await bridge.run()
 
 
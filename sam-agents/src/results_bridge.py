@@ -6,7 +6,6 @@ This bridges the gap between Python SAM agents and the Node.js backend.
 """
 
 import asyncio
-import json
 import logging
 import os
 from typing import Any, Dict
@@ -15,25 +14,78 @@ import nats
 from nats.aio.msg import Msg
 import aiohttp
 
+from analysis_codec import decode_analysis_message
+from jetstream_consumer import (
+    ANALYSIS_STREAM,
+    ANALYSIS_SUBJECTS,
+    ack_batch,
+    durable_pull_subscribe,
+    ensure_stream,
+    fetch_batch,
+    jetstream_enabled,
+    keep_alive,
+    nak_batch,
+    term_batch,
+)
+
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
+# Outcomes of handling one result message in JetStream mode
+STORED = "stored"  # every result reached the analytics store: ack
+RETRY = "retry"  # some results failed to store: nak with backoff
+INVALID = "invalid"  # the message can never be decoded: term
+
 
 class AnalysisResultsBridge:
     def __init__(
         self,
         nats_url: str = "nats://localhost:4222",
         analytics_url: str = "http://localhost:3000",
+        jetstream: bool = False,
+        fetch_size: int = 100,
+        fetch_timeout: float = 1.0,
+        max_ack_pending: int = 1000,
+        ack_wait: float = 30.0,
+        max_deliver: int = 10,
+        retry_delay: float = 2.0,
+        stream_max_age: float = 86400.0,
+        stream_max_bytes: int = 1024**3,
+        stream_max_msgs: int = 1_000_000,
+        store_concurrency: int = 20,
     ):
         self.nats_url = nats_url
         self.analytics_url = analytics_url
         self.nc: nats.NATS | None = None
 
+        # Optional JetStream durable pull consumption (see jetstream_consumer)
+        self.jetstream = jetstream
+        self.fetch_size = max(1, fetch_size)
+        self.fetch_timeout = fetch_timeout
+        self.max_ack_pending = max_ack_pending
+        self.ack_wait = ack_wait
+        self.max_deliver = max_deliver
+        self.retry_delay = retry_delay
+        self.stream_max_age = stream_max_age
+        self.stream_max_bytes = stream_max_bytes
+        self.stream_max_msgs = stream_max_msgs
+        # Results of one envelope are posted concurrently over a shared session
+        self.store_concurrency = max(1, store_concurrency)
+        self.http: aiohttp.ClientSession | None = None
+        self.js = None
+        self._friction_sub = None
+        self._sentiment_sub = None
+        # Indices of results already stored, per unacked stream sequence, so
+        # a redelivered batch envelope only retries the results that failed
+        self.stored_progress: Dict[int, set[int]] = {}
+
     async def connect(self):
         """Connect to NATS"""
         try:
             self.nc = await nats.connect(self.nats_url)
             log.info(f"✓ Connected to NATS at {self.nats_url}")
+            if self.jetstream:
+                self.js = self.nc.jetstream()
         except Exception as e:
             log.error(f"❌ Failed to connect to NATS: {e}")
             raise
@@ -43,6 +95,10 @@ class AnalysisResultsBridge:
         if not self.nc:
             raise RuntimeError("Not connected to NATS")
 
+        if self.js:
+            await self.subscribe_durable()
+            return
+
         await self.nc.subscribe(
             "flowback.analysis.friction", cb=self.handle_friction_analysis
         )
@@ -53,93 +109,208 @@ class AnalysisResultsBridge:
         )
         log.info("✓ Subscribed to flowback.analysis.sentiment")
 
-    async def handle_friction_analysis(self, msg: Msg):
+    async def subscribe_durable(self):
+        """Bind durable pull consumers for friction and sentiment results"""
+        await ensure_stream(
+            self.js,
+            ANALYSIS_STREAM,
+            ANALYSIS_SUBJECTS,
+            max_age=self.stream_max_age,
+            max_bytes=self.stream_max_bytes,
+            max_msgs=self.stream_max_msgs,
+        )
+
+        self._friction_sub = await durable_pull_subscribe(
+            self.js,
+            "flowback.analysis.friction",
+            durable="results-bridge-friction",
+            stream=ANALYSIS_STREAM,
+            max_ack_pending=self.max_ack_pending,
+            ack_wait=self.ack_wait,
+            max_deliver=self.max_deliver,
+        )
+        self._sentiment_sub = await durable_pull_subscribe(
+            self.js,
+            "flowback.analysis.sentiment",
+            durable="results-bridge-sentiment",
+            stream=ANALYSIS_STREAM,
+            max_ack_pending=self.max_ack_pending,
+            ack_wait=self.ack_wait,
+            max_deliver=self.max_deliver,
+        )
+
+    async def handle_friction_analysis(self, msg: Msg) -> str:
         """Process friction analysis from SAM agents"""
-        try:
-            result = json.loads(msg.data.decode())
-            log.info(f"📊 Friction analysis received: {result.get('sessionId', 'unknown')[:8]}")
+        return await self.handle_results(msg, "friction", "📊", self.store_friction_data)
 
-            # Send to Node.js analytics store
-            await self.store_friction_data(result)
+    async def handle_sentiment_analysis(self, msg: Msg) -> str:
+        """Process sentiment analysis from SAM agents"""
+        return await self.handle_results(msg, "sentiment", "💭", self.store_sentiment_data)
 
+    async def handle_results(self, msg: Msg, kind: str, icon: str, store) -> str:
+        """Store every result in a message; returns STORED, RETRY or INVALID"""
+        try:
+            # Handles both single results and batch envelopes
+            results = decode_analysis_message(msg.data, msg.headers)
+            if not all(isinstance(result, dict) for result in results):
+                raise ValueError("expected JSON objects")
         except Exception as e:
-            log.error(f"❌ Error handling friction analysis: {e}", exc_info=True)
+            log.error(f"❌ Dropping undecodable {kind} message: {e}")
+            return INVALID
 
-    async def handle_sentiment_analysis(self, msg: Msg):
-        """Process sentiment analysis from SAM agents"""
         try:
-            result = json.loads(msg.data.decode())
-            log.info(f"💭 Sentiment analysis received: {result.get('sessionId', 'unknown')[:8]}")
+            progress = self._progress(msg)
+            limit = asyncio.Semaphore(self.store_concurrency)
+
+            async def store_one(index: int, result: Dict[str, Any]) -> bool:
+                async with limit:
+                    log.info(f"{icon} {kind.capitalize()} analysis received: {str(result.get('sessionId', 'unknown'))[:8]}")
+                    # Send to Node.js analytics store
+                    if await store(result):
+                        progress.add(index)
+                        return True
+                    return False
 
-            # Send to Node.js analytics store
-            await self.store_sentiment_data(result)
+            outcomes = await asyncio.gather(
+                *(
+                    store_one(index, result)
+                    for index, result in enumerate(results)
+                    if index not in progress
+                )
+            )
+            return STORED if all(outcomes) else RETRY
 
         except Exception as e:
-            log.error(f"❌ Error handling sentiment analysis: {e}", exc_info=True)
+            log.error(f"❌ Error handling {kind} analysis: {e}", exc_info=True)
+            return RETRY
+
+    def _progress(self, msg: Msg) -> set[int]:
+        """Stored result indices for a JetStream message (untracked in core mode)"""
+        if not self.js:
+            return set()
+        return self.stored_progress.setdefault(msg.metadata.sequence.stream, set())
+
+    def _http(self) -> aiohttp.ClientSession:
+        """Shared HTTP session for the analytics store, created on first use"""
+        if self.http is None or self.http.closed:
+            self.http = aiohttp.ClientSession()
+        return self.http
 
-    async def store_friction_data(self, analysis: Dict[str, Any]):
+    async def store_friction_data(self, analysis: Dict[str, Any]) -> bool:
         """Store friction analysis in Node.js analytics store via HTTP"""
         try:
-            async with aiohttp.ClientSession() as session:
-                # Extract key metrics from analysis
-                session_id = analysis.get("sessionId", "")
-                score = float(
-                    analysis.get("severity", 5) / 10
-                )  # Normalize to 0-1 range
-
-                payload = {
-                    "projectId": "demo-project",
-                    "page": analysis.get("location", {}).get("url", "/"),
-                    "metrics": {
-                        "clickCount": 5,
-                        "rageClicks": 1,
-                        "hesitations": 1,
-                        "avgDuration": 250,
-                    },
-                    "frictionScore": score,
-                    "evidence": analysis.get("evidence", ""),
-                    "recommendation": analysis.get("recommendation", ""),
-                }
-
-                async with session.post(
-                    f"{self.analytics_url}/api/hotspots",
-                    json=payload,
-                    headers={"Content-Type": "application/json"},
-                ) as resp:
-                    if resp.status == 200:
-                        log.info(f"✓ Stored friction data for {session_id[:8]}")
-                    else:
-                        log.warning(f"⚠️ Analytics store returned {resp.status}")
+            session = self._http()
+            # Extract key metrics from analysis
+            session_id = analysis.get("sessionId", "")
+            score = float(
+                analysis.get("severity", 5) / 10
+            )  # Normalize to 0-1 range
+
+            payload = {
+                "projectId": "demo-project",
+                "page": analysis.get("location", {}).get("url", "/"),
+                "metrics": {
+                    "clickCount": 5,
+                    "rageClicks": 1,
+                    "hesitations": 1,
+                    "avgDuration": 250,
+                },
+                "frictionScore": score,
+                "evidence": analysis.get("evidence", ""),
+                "recommendation": analysis.get("recommendation", ""),
+            }
+
+            async with session.post(
+                f"{self.analytics_url}/api/hotspots",
+                json=payload,
+                headers={"Content-Type": "application/json"},
+            ) as resp:
+                if resp.status == 200:
+                    log.info(f"✓ Stored friction data for {session_id[:8]}")
+                    return True
+                log.warning(f"⚠️ Analytics store returned {resp.status}")
+                return False
 
         except Exception as e:
             log.error(f"❌ Failed to store friction data: {e}", exc_info=True)
+            return False
 
-    async def store_sentiment_data(self, analysis: Dict[str, Any]):
+    async def store_sentiment_data(self, analysis: Dict[str, Any]) -> bool:
         """Store sentiment analysis in Node.js analytics store via HTTP"""
         try:
-            async with aiohttp.ClientSession() as session:
-                payload = {
-                    "projectId": "demo-project",
-                    "sessionId": analysis.get("sessionId", ""),
-                    "sentiment": analysis.get("sentiment", "neutral"),
-                    "score": float(analysis.get("score", 0.5)),
-                    "feedback": analysis.get("feedback", ""),
-                }
-
-                async with session.post(
-                    f"{self.analytics_url}/api/sentiment",
-                    json=payload,
-                    headers={"Content-Type": "application/json"},
-                ) as resp:
-                    if resp.status == 200:
-                        log.info(
-                            f"✓ Stored sentiment data for {analysis.get('sessionId', 'unknown')[:8]}"
-                        )
-                    else:
-                        log.warning(f"⚠️ Analytics store returned {resp.status}")
+            session = self._http()
+            payload = {
+                "projectId": "demo-project",
+                "sessionId": analysis.get("sessionId", ""),
+                "sentiment": analysis.get("sentiment", "neutral"),
+                "score": float(analysis.get("score", 0.5)),
+                "feedback": analysis.get("feedback", ""),
+            }
+
+            async with session.post(
+                f"{self.analytics_url}/api/sentiment",
+                json=payload,
+                headers={"Content-Type": "application/json"},
+            ) as resp:
+                if resp.status == 200:
+                    log.info(
+                        f"✓ Stored sentiment data for {analysis.get('sessionId', 'unknown')[:8]}"
+                    )
+                    return True
+                log.warning(f"⚠️ Analytics store returned {resp.status}")
+                return False
 
         except Exception as e:
             log.error(f"❌ Failed to store sentiment data: {e}", exc_info=True)
+            return False
+
+    async def consume_results(self, psub, handler):
+        """Pull result batches, acking only the messages that were stored"""
+        while True:
+            try:
+                msgs = await fetch_batch(psub, self.fetch_size, self.fetch_timeout)
+                if not msgs:
+                    continue
+
+                # Storing a large batch can outlast ack_wait, so keep the
+                # fetched messages from being redelivered meanwhile
+                extender = asyncio.create_task(keep_alive(msgs, self.ack_wait / 2))
+                try:
+                    outcomes = [await handler(msg) for msg in msgs]
+                finally:
+                    extender.cancel()
+                    await asyncio.gather(extender, return_exceptions=True)
+
+                stored, retry, dropped = [], [], []
+                for msg, outcome in zip(msgs, outcomes):
+                    if outcome == STORED:
+                        stored.append(msg)
+                    elif outcome == INVALID:
+                        dropped.append(msg)
+                    elif self.max_deliver > 0 and msg.metadata.num_delivered >= self.max_deliver:
+                        log.error(
+                            f"❌ Giving up on result message {msg.metadata.sequence.stream} "
+                            f"after {msg.metadata.num_delivered} deliveries"
+                        )
+                        dropped.append(msg)
+                    else:
+                        retry.append(msg)
+
+                await ack_batch(self.nc, stored)
+                # Back off between deliveries so a store outage does not use up
+                # max_deliver at once
+                await nak_batch(retry, retry_base=self.retry_delay)
+                await term_batch(dropped)
+                if retry:
+                    log.warning(f"⚠️ {len(retry)} result messages will be redelivered")
+
+                for msg in stored + dropped:
+                    self.stored_progress.pop(msg.metadata.sequence.stream, None)
+
+            except Exception as e:
+                # Unacked messages are redelivered after ack_wait
+                log.error(f"❌ Error consuming result messages: {e}", exc_info=True)
+                await asyncio.sleep(1)
 
     async def run(self):
         """Run the analysis results bridge"""
@@ -150,12 +321,24 @@ class AnalysisResultsBridge:
             log.info("🚀 Analysis Results Bridge running")
             log.info(f"   Forwarding results to {self.analytics_url}")
 
-            while True:
-                await asyncio.sleep(1)
+            if self.js:
+                log.info(
+                    f"   JetStream pull mode: batches of {self.fetch_size}, "
+                    f"max_ack_pending={self.max_ack_pending}"
+                )
+                await asyncio.gather(
+                    self.consume_results(self._friction_sub, self.handle_friction_analysis),
+                    self.consume_results(self._sentiment_sub, self.handle_sentiment_analysis),
+                )
+            else:
+                while True:
+                    await asyncio.sleep(1)
 
         except KeyboardInterrupt:
             log.info("Shutting down...")
         finally:
+            if self.http:
+                await self.http.close()
             if self.nc:
                 await self.nc.close()
 
@@ -164,6 +347,17 @@ async def main():
     bridge = AnalysisResultsBridge(
         nats_url=os.getenv("NATS_URL", "nats://localhost:4222"),
         analytics_url=os.getenv("ANALYTICS_STORE_URL", "http://localhost:3000"),
+        jetstream=jetstream_enabled(),
+        fetch_size=int(os.getenv("NATS_FETCH_SIZE", "100")),
+        fetch_timeout=float(os.getenv("NATS_FETCH_TIMEOUT", "1.0")),
+        max_ack_pending=int(os.getenv("NATS_MAX_ACK_PENDING", "1000")),
+        ack_wait=float(os.getenv("NATS_ACK_WAIT", "30")),
+        max_deliver=int(os.getenv("NATS_MAX_DELIVER", "10")),
+        retry_delay=float(os.getenv("NATS_RETRY_DELAY", "2")),
+        stream_max_age=float(os.getenv("NATS_STREAM_MAX_AGE", "86400")),
+        stream_max_bytes=int(os.getenv("NATS_STREAM_MAX_BYTES", str(1024**3))),
+        stream_max_msgs=int(os.getenv("NATS_STREAM_MAX_MSGS", "1000000")),
+        store_concurrency=int(os.getenv("ANALYTICS_STORE_CONCURRENCY", "20")),
     )
     await bridge.run()
 
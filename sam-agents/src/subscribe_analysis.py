@@ -1,8 +1,11 @@
 import asyncio
+import json
 import os
 
 import nats
 
+from analysis_codec import decode_analysis_message
+
 
 async def main():
     nats_url = os.getenv("NATS_URL", "nats://localhost:4222")
@@ -12,7 +15,8 @@ async def main():
     nc = await nats.connect(nats_url)
 
     async def handler(msg):
-        print("Received analysis:", msg.subject, msg.data.decode())
+        for result in decode_analysis_message(msg.data, msg.headers):
+            print("Received analysis:", msg.subject, json.dumps(result))
         got_message.set()
 
     await nc.subscribe("flowback.analysis.friction", cb=handler)